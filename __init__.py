@@ -1,3 +1,3 @@
-from .wandb_carbs import WandbCarbs, create_sweep
+from .wandb_carbs import Pow2WandbCarbs, WandbCarbs, create_sweep
 
-__all__ = ['WandbCarbs', 'create_sweep']
+__all__ = ['WandbCarbs', 'Pow2WandbCarbs', 'create_sweep']
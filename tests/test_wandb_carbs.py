@@ -0,0 +1,518 @@
+import itertools
+import threading
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+from carbs import LinearSpace, LogSpace
+
+import wandb_carbs
+from wandb_carbs import WandbCarbs
+
+
+def _heartbeat():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def fake_api_run(run_id, state, config=None, objective=None, cost=None, name=None):
+    summary = {"carbs.state": state}
+    if objective is not None:
+        summary["carbs.objective"] = objective
+    if cost is not None:
+        summary["carbs.cost"] = cost
+    return SimpleNamespace(
+        id=run_id,
+        name=name or f"run-{run_id}",
+        summary=summary,
+        config=config or {},
+        _attrs={"heartbeatAt": _heartbeat()},
+    )
+
+
+class FakeRuns:
+    """Mimics wandb's Runs paginator: fetches once, then replays the same runs."""
+
+    def __init__(self, api, filters, lazy):
+        self.api = api
+        self.filters = filters
+        self.lazy = lazy
+        self.objects = None
+
+    def __iter__(self):
+        if self.objects is None:
+            self.api.fetches += 1
+            states = self.filters["summary_metrics.carbs.state"]["$in"]
+            self.objects = [
+                FakeLazyRun(self.api, run) if self.lazy else run
+                for run in self.api.runs_by_id.values()
+                if run.summary["carbs.state"] in states
+            ]
+        return iter(list(self.objects))
+
+
+class FakeLazyRun:
+    """A run listed with lazy=True: reading its config or summary costs a request."""
+
+    def __init__(self, api, run):
+        self._api = api
+        self._run = run
+        self.id = run.id
+        self.name = run.name
+        self._attrs = run._attrs
+
+    @property
+    def summary(self):
+        self._api.full_loads += 1
+        return self._run.summary
+
+    @property
+    def config(self):
+        self._api.full_loads += 1
+        return self._run.config
+
+
+class FakeApi:
+    """Mimics wandb.Api.runs, including memoizing the paginator per query."""
+
+    def __init__(self, runs=()):
+        self.runs_by_id = {run.id: run for run in runs}
+        self.calls = []
+        self.fetches = 0
+        self.full_loads = 0
+        self._runs = {}
+
+    def add(self, run):
+        self.runs_by_id[run.id] = run
+
+    def runs(self, path=None, filters=None, order="+created_at", per_page=50, lazy=True):
+        self.calls.append({
+            "path": path, "filters": filters, "order": order, "per_page": per_page, "lazy": lazy})
+        key = (path or "") + str(filters) + str(order)
+        if not self._runs.get(key):
+            self._runs[key] = FakeRuns(self, filters, lazy)
+        return self._runs[key]
+
+
+class FakeOldApi(FakeApi):
+    """wandb releases before lazy loading, whose Api.runs has no lazy argument."""
+
+    def runs(self, path=None, filters=None, order="+created_at", per_page=50):
+        return super().runs(path, filters, order, per_page, lazy=False)
+
+
+class FakeCarbs:
+    def __init__(self, param_names=("lr", "batch")):
+        self.params = [SimpleNamespace(name=name, search_center=i + 1.0) for i, name in enumerate(param_names)]
+        self.remembered = []
+        self.observed = []
+        self.success_observations = []
+        self.failure_observations = []
+
+    def _set_seed(self, seed):
+        pass
+
+    def _param_space_real_to_basic_space_real(self, suggestion):
+        return [suggestion[param.name] for param in self.params]
+
+    def _remember_suggestion(self, suggestion, suggestion_in_basic, suggestion_id):
+        self.remembered.append((suggestion_id, suggestion))
+
+    def observe(self, observation):
+        self.observed.append(observation)
+
+    def suggest(self):
+        suggestion = {param.name: 3.0 for param in self.params}
+        suggestion["suggestion_uuid"] = "new"
+        return SimpleNamespace(suggestion=suggestion)
+
+
+class FakeConfig:
+    def __init__(self):
+        self.values = {}
+
+    def update(self, values, allow_val_change=False):
+        self.values.update(values)
+
+
+class FakeWandbRun:
+    def __init__(self, run_id, sweep_id="sweep"):
+        self.id = run_id
+        self.name = f"run-{run_id}"
+        self.sweep_id = sweep_id
+        self.entity = "entity"
+        self.project = "project"
+        self.summary = {}
+        self.config = FakeConfig()
+
+
+@pytest.fixture(autouse=True)
+def clear_runs_cache():
+    wandb_carbs._runs_cache.clear()
+    wandb_carbs._runs_cache_generations.clear()
+    yield
+    wandb_carbs._runs_cache.clear()
+    wandb_carbs._runs_cache_generations.clear()
+
+
+@pytest.fixture
+def api(monkeypatch):
+    api = FakeApi()
+    monkeypatch.setattr(wandb_carbs, "_shared_api", api)
+    return api
+
+
+def test_loads_runs_in_order_with_page_size(api):
+    api.add(fake_api_run("a", "success", {"lr": 0.1, "batch": 8}, objective=1.0, cost=2.0))
+    api.add(fake_api_run("b", "failure", {"lr": 0.2, "batch": 16}))
+    api.add(fake_api_run("c", "running", {"lr": 0.3, "batch": 32}))
+
+    carbs = FakeCarbs()
+    wc = WandbCarbs(carbs, FakeWandbRun("me"))
+
+    assert api.calls == [{
+        "path": "entity/project",
+        "filters": {
+            "sweep": "sweep",
+            "summary_metrics.carbs.state": {"$in": ["running", "success", "failure"]},
+        },
+        "order": "+created_at",
+        "per_page": wandb_carbs._RUNS_PER_PAGE,
+        "lazy": False,
+    }]
+    assert [run_id for run_id, _ in carbs.remembered] == ["a", "b", "c"]
+    assert [(o.output, o.cost, o.is_failure) for o in carbs.observed] == [
+        (1.0, 2.0, False), (0, 0, True)]
+    assert (wc._num_observations, wc._num_failures, wc._num_running) == (1, 1, 1)
+    assert wc._summary["carbs.state"] == "running"
+
+
+def test_lists_runs_with_full_data(api):
+    api.add(fake_api_run("a", "success", {"lr": 0.1, "batch": 8}, objective=1.0))
+    api.add(fake_api_run("b", "running", {"lr": 0.2, "batch": 16}))
+
+    WandbCarbs(FakeCarbs(), FakeWandbRun("me"))
+
+    assert api.full_loads == 0
+
+
+def test_supports_api_without_lazy_argument(monkeypatch):
+    api = FakeOldApi([fake_api_run("a", "success", {"lr": 0.1, "batch": 8}, objective=1.0)])
+    monkeypatch.setattr(wandb_carbs, "_shared_api", api)
+
+    carbs = FakeCarbs()
+    WandbCarbs(carbs, FakeWandbRun("me"))
+
+    assert [run_id for run_id, _ in carbs.remembered] == ["a"]
+
+
+def test_run_fields_maps_id_name_and_defaults(api):
+    wc = WandbCarbs(FakeCarbs(), FakeWandbRun("me"))
+    run = fake_api_run("abc123", "success", {"lr": 0.5, "other": 7}, name="pretty-name")
+
+    fields = wc._run_fields(run)
+
+    assert fields["id"] == "abc123"
+    assert fields["name"] == "pretty-name"
+    assert fields["objective"] == 0
+    assert fields["cost"] == 0
+    # Missing hyperparameters fall back to the search center, extra keys are dropped
+    assert fields["config"] == {"lr": 0.5, "batch": 2.0}
+
+
+def test_suggestion_from_run_uses_run_id_as_uuid(api):
+    api.add(fake_api_run("a", "success", {"lr": 0.1, "batch": 8}, objective=1.0))
+    carbs = FakeCarbs()
+    WandbCarbs(carbs, FakeWandbRun("me"))
+
+    assert carbs.remembered == [("a", {"lr": 0.1, "batch": 8, "suggestion_uuid": "a"})]
+
+
+def test_fetch_errors_propagate(api, monkeypatch):
+    def runs(**kwargs):
+        raise RuntimeError("server error")
+
+    monkeypatch.setattr(api, "runs", runs)
+    with pytest.raises(RuntimeError, match="server error"):
+        WandbCarbs(FakeCarbs(), FakeWandbRun("me"))
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(wandb_carbs.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_runs_cache_expires_after_ttl(api, clock):
+    api.add(fake_api_run("a", "success", objective=1.0))
+    wc = WandbCarbs(FakeCarbs(), FakeWandbRun("me"))
+    assert len(api.calls) == 1
+
+    list(wc._get_runs())
+    list(wc._get_runs())
+    assert len(api.calls) == 2
+
+    clock[0] += wandb_carbs._RUNS_CACHE_TTL - 1
+    list(wc._get_runs())
+    assert len(api.calls) == 2
+
+    clock[0] += 2
+    list(wc._get_runs())
+    assert len(api.calls) == 3
+
+
+def test_runs_cache_drops_expired_entries(api, clock):
+    api.add(fake_api_run("a", "success", objective=1.0))
+    wc = WandbCarbs(FakeCarbs(), FakeWandbRun("me"))
+    list(wc._get_runs())
+    assert wc._runs_cache_key in wandb_carbs._runs_cache
+
+    clock[0] += wandb_carbs._RUNS_CACHE_TTL
+    runs = wc._get_runs()
+    next(runs)
+
+    # The expired entry is gone as soon as it is looked up, before the refetch finishes
+    assert wc._runs_cache_key not in wandb_carbs._runs_cache
+    runs.close()
+
+
+def test_fetch_overlapping_invalidation_is_not_cached(api, clock):
+    api.add(fake_api_run("a", "success", objective=1.0))
+    first = WandbCarbs(FakeCarbs(), FakeWandbRun("first"))
+
+    runs = first._get_runs()
+    next(runs)
+    # Another instance starts running while this fetch is in flight
+    WandbCarbs(FakeCarbs(), FakeWandbRun("second"))
+    list(runs)
+
+    assert first._runs_cache_key not in wandb_carbs._runs_cache
+
+
+def test_runs_cache_serves_concurrent_instances(api, clock):
+    api.add(fake_api_run("a", "success", objective=1.0))
+    first = WandbCarbs(FakeCarbs(), FakeWandbRun("first"))
+    list(first._get_runs())
+
+    second_carbs = FakeCarbs()
+    WandbCarbs(second_carbs, FakeWandbRun("second"))
+
+    assert len(api.calls) == 2
+    assert [run_id for run_id, _ in second_carbs.remembered] == ["a"]
+
+
+def test_second_instance_sees_first_running(api, clock):
+    api.add(fake_api_run("a", "success", objective=1.0))
+    first_run = FakeWandbRun("first")
+    WandbCarbs(FakeCarbs(), first_run)
+    # The server now reports the first worker as running
+    api.add(fake_api_run("first", "running", {"lr": 0.3, "batch": 3}))
+
+    second_carbs = FakeCarbs()
+    WandbCarbs(second_carbs, FakeWandbRun("second"))
+
+    assert [run_id for run_id, _ in second_carbs.remembered] == ["a", "first"]
+    assert len(second_carbs.observed) == 1
+
+
+def test_skips_own_run(api, clock):
+    api.add(fake_api_run("a", "success", objective=1.0))
+    api.add(fake_api_run("me", "running"))
+
+    carbs = FakeCarbs()
+    wc = WandbCarbs(carbs, FakeWandbRun("me"))
+
+    assert [run_id for run_id, _ in carbs.remembered] == ["a"]
+    assert wc._num_running == 0
+
+
+@pytest.mark.parametrize("record", [
+    lambda wc: wc.record_observation(1.0, 2.0),
+    lambda wc: wc.record_failure(),
+])
+def test_recording_invalidates_runs_cache(api, clock, record):
+    wc = WandbCarbs(FakeCarbs(), FakeWandbRun("me"))
+    list(wc._get_runs())
+    assert wc._runs_cache_key in wandb_carbs._runs_cache
+
+    record(wc)
+
+    assert wc._runs_cache_key not in wandb_carbs._runs_cache
+
+
+def test_shared_api_refetches_after_invalidation(api, clock):
+    api.add(fake_api_run("a", "success", objective=1.0))
+    first = WandbCarbs(FakeCarbs(), FakeWandbRun("first"))
+    first.record_observation(1.0, 2.0)
+    api.add(fake_api_run("first", "success", {"lr": 0.3, "batch": 3}, objective=1.0))
+
+    second_carbs = FakeCarbs()
+    WandbCarbs(second_carbs, FakeWandbRun("second"))
+
+    assert api.fetches == 2
+    assert [run_id for run_id, _ in second_carbs.remembered] == ["a", "first"]
+
+
+def test_runs_cache_is_keyed_by_params(api, clock):
+    api.add(fake_api_run("a", "success", {"lr": 0.1, "batch": 8, "depth": 4}, objective=1.0))
+    first = WandbCarbs(FakeCarbs(("lr", "batch")), FakeWandbRun("first"))
+    list(first._get_runs())
+
+    second_carbs = FakeCarbs(("lr", "depth"))
+    WandbCarbs(second_carbs, FakeWandbRun("second"))
+
+    assert second_carbs.remembered == [("a", {"lr": 0.1, "depth": 4, "suggestion_uuid": "a"})]
+
+
+@pytest.mark.parametrize("exponent, expected", [
+    (0, 1),
+    (3, 8),
+    (3.0, 8),
+    (-1.0, 0.5),
+    (4.6, 2 ** 4.6),
+])
+def test_pow2_matches_float_power(exponent, expected):
+    assert wandb_carbs._pow2(exponent) == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("value, expected", [
+    (1, 0),
+    (8, 3),
+    (8.0, 3),
+    (12, 3),
+    (12.7, 3),
+    (0.5, -1),
+])
+def test_log2_matches_truncated_log2(value, expected):
+    assert wandb_carbs._log2(value) == expected
+
+
+@pytest.mark.parametrize("value", [0, -4])
+def test_log2_rejects_non_positive(value):
+    with pytest.raises(ValueError):
+        wandb_carbs._log2(value)
+
+
+def test_pow2_wandb_carbs_round_trips_exponents(api):
+    api.add(fake_api_run("a", "success", {"lr": 0.5, "batch": 16}, objective=1.0))
+    api.add(fake_api_run("b", "success", {"lr": 0.1, "batch": 0}, objective=1.0))
+
+    carbs = FakeCarbs()
+    wc = wandb_carbs.Pow2WandbCarbs(carbs, {"batch"}, FakeWandbRun("me"))
+
+    assert carbs.remembered == [("a", {"lr": 0.5, "batch": 4, "suggestion_uuid": "a"})]
+    assert wc._invalid == 1
+    assert wc.suggest() == {"lr": 3.0, "batch": 8, "suggestion_uuid": "new"}
+
+
+def _wait_for_new_threads(before, timeout=2.0):
+    new_threads = [t for t in threading.enumerate() if t not in before]
+    for thread in new_threads:
+        thread.join(timeout)
+    return [t for t in new_threads if t.is_alive()]
+
+
+def test_prefetch_preserves_order():
+    assert list(wandb_carbs._prefetch(range(200), maxsize=4)) == list(range(200))
+
+
+def test_prefetch_reraises_producer_errors():
+    def items():
+        yield 1
+        raise RuntimeError("page failed")
+
+    consumed = []
+    with pytest.raises(RuntimeError, match="page failed"):
+        for item in wandb_carbs._prefetch(items()):
+            consumed.append(item)
+    assert consumed == [1]
+
+
+def test_prefetch_reraises_base_exceptions():
+    class Abort(BaseException):
+        pass
+
+    def items():
+        yield 1
+        raise Abort()
+
+    raised = []
+
+    def consume():
+        try:
+            list(wandb_carbs._prefetch(items()))
+        except Abort as e:
+            raised.append(e)
+
+    # Consume on a thread so a missing sentinel fails the test instead of hanging it
+    consumer = threading.Thread(target=consume, daemon=True)
+    consumer.start()
+    consumer.join(2.0)
+
+    assert not consumer.is_alive()
+    assert len(raised) == 1
+
+
+def test_prefetch_thread_stops_when_consumer_closes():
+    before = set(threading.enumerate())
+    items = wandb_carbs._prefetch(itertools.count(), maxsize=2)
+    assert next(items) == 0
+    items.close()
+
+    assert _wait_for_new_threads(before) == []
+
+
+def test_prefetch_thread_stops_when_replay_fails(api, monkeypatch):
+    for i in range(wandb_carbs._PREFETCH_SIZE * 2):
+        api.add(fake_api_run(f"r{i}", "success", objective=1.0))
+
+    carbs = FakeCarbs()
+
+    def observe(observation):
+        raise RuntimeError("observe failed")
+
+    monkeypatch.setattr(carbs, "observe", observe)
+    before = set(threading.enumerate())
+    with pytest.raises(RuntimeError, match="observe failed"):
+        WandbCarbs(carbs, FakeWandbRun("me"))
+
+    assert _wait_for_new_threads(before) == []
+
+
+class _CustomLogSpace(LogSpace):
+    pass
+
+
+class _UnknownSpace:
+    min = 0.0
+    max = 1.0
+
+
+@pytest.mark.parametrize("space, expected", [
+    (LogSpace(min=1e-5, max=1e-1), "log_uniform_values"),
+    (_CustomLogSpace(min=1e-5, max=1e-1), "log_uniform_values"),
+    (LinearSpace(min=16, max=128, is_integer=True), "int_uniform"),
+    (LinearSpace(min=0.0, max=1.0), "uniform"),
+    (_UnknownSpace(), None),
+])
+def test_wandb_distribution(space, expected):
+    assert wandb_carbs._wandb_distribution(SimpleNamespace(name="p", space=space)) == expected
+
+
+def test_sweep_cfg_from_carbs_params():
+    params = [
+        SimpleNamespace(name="lr", space=LogSpace(min=1e-5, max=1e-1)),
+        SimpleNamespace(name="batch", space=LinearSpace(min=16, max=128, is_integer=True)),
+    ]
+
+    cfg = wandb_carbs._wandb_sweep_cfg_from_carbs_params("sweep", params)
+
+    assert cfg == {
+        "method": "bayes",
+        "metric": {"goal": "maximize", "name": "carbs.objective"},
+        "parameters": {
+            "lr": {"min": 1e-5, "max": 1e-1, "distribution": "log_uniform_values"},
+            "batch": {"min": 16, "max": 128, "distribution": "int_uniform"},
+        },
+        "name": "sweep",
+    }
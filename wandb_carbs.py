@@ -1,10 +1,13 @@
+import inspect
 import json
 import logging
 import math
+import os
+import queue
 import random
+import threading
 import time
 import traceback
-from copy import deepcopy
 from datetime import datetime, timezone
 from typing import List, Set
 
@@ -19,9 +22,92 @@ from carbs import (
     SuggestionInBasic,
 )
 
+try:
+    import orjson
+
+    def _jdumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY).decode()
+except ImportError:
+    def _jdumps(obj):
+        return json.dumps(obj, indent=2)
+
 logger = logging.getLogger("wandb_carbs")
 # logger.setLevel(logging.DEBUG)
 
+# Number of runs fetched per page when loading previous runs
+_RUNS_PER_PAGE = 500
+_RUNS_ORDER = "+created_at"
+
+# Number of fetched runs buffered ahead of the CARBS replay
+_PREFETCH_SIZE = 64
+# Seconds the prefetch thread waits on a full buffer before checking for a stop
+_PREFETCH_PUT_TIMEOUT = 0.1
+
+# Runs loaded per (entity, project, sweep_id, param names), shared by all
+# WandbCarbs instances in this process for _RUNS_CACHE_TTL seconds
+_RUNS_CACHE_TTL = 30
+_runs_cache = {}
+# Bumped on every invalidation, so a fetch that overlaps one isn't cached
+_runs_cache_generations = {}
+_runs_cache_lock = threading.Lock()
+
+# wandb.Api shared by all WandbCarbs instances in this process, so they
+# reuse its authenticated client and HTTP connection pool
+_shared_api = None
+_shared_api_lock = threading.Lock()
+
+
+def _get_api():
+    global _shared_api
+    with _shared_api_lock:
+        if _shared_api is None:
+            _shared_api = wandb.Api()
+        return _shared_api
+
+
+def _prefetch(iterable, maxsize=_PREFETCH_SIZE):
+    """
+    Iterate over `iterable` in a background thread, buffering up to `maxsize` items.
+
+    Exceptions raised by `iterable` are re-raised in the consuming thread. The
+    background thread stops once the consumer stops iterating.
+    """
+    items = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=_PREFETCH_PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except BaseException as e:
+            put((done, e))
+        else:
+            put((done, None))
+
+    threading.Thread(target=produce, name="wandb_carbs-prefetch", daemon=True).start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+
 class WandbCarbs:
     def __init__(self, carbs: CARBS, wandb_run = None):
         """
@@ -33,10 +119,29 @@ class WandbCarbs:
         """
         self._wandb_run = wandb_run or wandb.run
         self._sweep_id = self._wandb_run.sweep_id
-        self._api = wandb.Api()
+        self._entity = self._wandb_run.entity
+        self._project = self._wandb_run.project
+        self._path = f"{self._entity}/{self._project}"
+        self._run_id = self._wandb_run.id
+        self._summary = self._wandb_run.summary
+        self._runs_filter = {
+            "sweep": self._sweep_id,
+            "summary_metrics.carbs.state": {"$in": ["running", "success", "failure"]},
+        }
+        self._api = _get_api()
+        # Newer wandb releases load each run's config and summary with a separate
+        # request unless runs are listed with lazy=False, which older ones reject
+        self._runs_kwargs = (
+            {"lazy": False} if "lazy" in inspect.signature(self._api.runs).parameters else {})
 
         self._carbs = carbs
-        self._carbs._set_seed(int(time.time()))
+        self._param_names = tuple(param.name for param in self._carbs.params)
+        self._param_centers = tuple(param.search_center for param in self._carbs.params)
+        self._runs_cache_key = (self._entity, self._project, self._sweep_id, self._param_names)
+        # Mix in the pid and a nanosecond clock so workers started in the
+        # same second don't share a seed
+        self._carbs._set_seed(
+            (hash(self._sweep_id) ^ (os.getpid() << 16) ^ time.monotonic_ns()) & 0xFFFFFFFF)
         self._num_observations = 0
         self._num_failures = 0
         self._num_running = 0
@@ -44,18 +149,18 @@ class WandbCarbs:
         self._invalid = 0
         self._observations = []
 
-        assert self._wandb_run.summary.get("carbs.state") is None, \
+        assert self._summary.get("carbs.state") is None, \
             f"Run {self._wandb_run.name} already has carbs state"
 
-        self._wandb_run.summary.update({"carbs.state": "initializing"})
         self._load_runs()
         self._generate_carbs_suggestion()
 
-        wandb_config = self._transform_suggestion(deepcopy(self._suggestion))
+        wandb_config = self._transform_suggestion(dict(self._suggestion))
         del wandb_config["suggestion_uuid"]
         self._wandb_run.config.__dict__["_locked"] = {}
         self._wandb_run.config.update(wandb_config, allow_val_change=True)
-        self._wandb_run.summary.update({"carbs.state": "running"})
+        self._summary.update({"carbs.state": "running"})
+        self._invalidate_runs_cache()
 
     def record_observation(self, objective: float, cost: float, allow_update: bool = False):
         """
@@ -67,14 +172,15 @@ class WandbCarbs:
             allow_update (bool, optional): If True, allows updating even if the run is not in "running" state.
         """
         if not allow_update:
-            assert self._wandb_run.summary["carbs.state"] == "running", \
-                f"Run is not running, cannot record observation {self._wandb_run.summary}"
+            assert self._summary["carbs.state"] == "running", \
+                f"Run is not running, cannot record observation {self._summary}"
 
-        self._wandb_run.summary.update({
+        self._summary.update({
             "carbs.objective": objective,
             "carbs.cost": cost,
             "carbs.state": "success"
         })
+        self._invalidate_runs_cache()
         logger.info(f"Recording observation ({objective}, {cost}) for {self._wandb_run.name}")
 
     def record_failure(self):
@@ -82,7 +188,8 @@ class WandbCarbs:
         Record a failure for the current run.
         """
         logger.info(f"Recording failure for {self._wandb_run.name}")
-        self._wandb_run.summary.update({"carbs.state": "failure"})
+        self._summary.update({"carbs.state": "failure"})
+        self._invalidate_runs_cache()
 
 
     def suggest(self):
@@ -92,7 +199,7 @@ class WandbCarbs:
         Returns:
             dict: The current suggestion.
         """
-        return self._transform_suggestion(deepcopy(self._suggestion))
+        return self._transform_suggestion(dict(self._suggestion))
 
     def _transform_suggestion(self, suggestion):
         return suggestion
@@ -100,7 +207,9 @@ class WandbCarbs:
     def _load_runs(self):
         logger.info(f"Loading previous runs from sweep {self._sweep_id}")
 
-        for run in self._get_runs_from_wandb():
+        for run in self._get_runs():
+            if run["id"] == self._run_id:
+                continue
             self._update_carbs_from_run(run)
 
         logger.info("Initialized CARBS with " + json.dumps({
@@ -111,84 +220,128 @@ class WandbCarbs:
             "invalid" : self._invalid
         }))
 
+    def _invalidate_runs_cache(self):
+        key = self._runs_cache_key
+        with _runs_cache_lock:
+            _runs_cache.pop(key, None)
+            _runs_cache_generations[key] = _runs_cache_generations.get(key, 0) + 1
+
+    def _get_runs(self):
+        key = self._runs_cache_key
+        with _runs_cache_lock:
+            cached = _runs_cache.get(key)
+            if cached is not None and time.monotonic() - cached[0] >= _RUNS_CACHE_TTL:
+                del _runs_cache[key]
+                cached = None
+            generation = _runs_cache_generations.get(key, 0)
+        if cached is not None:
+            logger.debug(f"Using {len(cached[1])} cached runs from sweep {self._sweep_id}")
+            yield from cached[1]
+            return
+
+        # Fetch the next pages while the caller replays the runs into CARBS
+        fetched_at = time.monotonic()
+        runs = []
+        for run in _prefetch(self._get_runs_from_wandb()):
+            runs.append(run)
+            yield run
+        with _runs_cache_lock:
+            if _runs_cache_generations.get(key, 0) == generation:
+                _runs_cache[key] = (fetched_at, runs)
+
     def _get_runs_from_wandb(self):
-        runs = self._api.runs(
-            path=f"{self._wandb_run.entity}/{self._wandb_run.project}",
-            filters={
-                "sweep": self._sweep_id,
-                "summary_metrics.carbs.state": {"$exists": True},
-                "id": {"$ne": self._wandb_run.id}
+        # Api.runs memoizes its paginator per path, filters and order, and an
+        # exhausted paginator never refetches. Drop the memoized copy so every
+        # fetch, from any instance sharing the Api, gets a fresh one.
+        with _shared_api_lock:
+            runs = self._api.runs(
+                path=self._path,
+                filters=self._runs_filter,
+                order=_RUNS_ORDER,
+                per_page=_RUNS_PER_PAGE,
+                **self._runs_kwargs,
+            )
+            self._api._runs.clear()
+        for run in runs:
+            yield self._run_fields(run)
+
+    def _run_fields(self, run):
+        summary = run.summary
+        return {
+            "id": run.id,
+            "name": run.name,
+            "state": summary["carbs.state"],
+            "objective": summary.get("carbs.objective", 0),
+            "cost": summary.get("carbs.cost", 0),
+            "heartbeat_at": run._attrs["heartbeatAt"],
+            "config": {
+                name: run.config.get(name, center)
+                for name, center in zip(self._param_names, self._param_centers)
             },
-            order="+created_at"
-        )
-        return runs
+        }
 
     def _update_carbs_from_run(self, run):
-        if run.summary["carbs.state"] == "initializing":
-            logger.debug(f"skipping run {run.name} because it is initializing")
-
-        if run.summary["carbs.state"] == "running":
+        if run["state"] == "running":
             last_hb = datetime.strptime(
-                run._attrs["heartbeatAt"], "%Y-%m-%dT%H:%M:%S%fZ").replace(tzinfo=timezone.utc)
+                run["heartbeat_at"], "%Y-%m-%dT%H:%M:%S%fZ").replace(tzinfo=timezone.utc)
             if (datetime.now(timezone.utc) - last_hb).total_seconds() > 5*60:
-                logger.debug(f"skipping run {run.name} because it has not heartbeated in the last 5 minutes")
+                logger.debug(f"skipping run {run['name']} because it has not heartbeated in the last 5 minutes")
                 self._defunct += 1
                 return
 
         try:
             suggestion = self._suggestion_from_run(run)
         except Exception as e:
-            logger.warning(f"Failed to get suggestion from run {run.name}: {e}")
+            logger.warning(f"Failed to get suggestion from run {run['name']}: {e}")
             self._invalid += 1
             return
 
         self._carbs._remember_suggestion(
             suggestion,
             SuggestionInBasic(self._carbs._param_space_real_to_basic_space_real(suggestion)),
-            run.id
+            run["id"]
         )
 
-        if run.summary["carbs.state"] == "running":
-            logger.debug(f"recording suggestion run {run.name} that is still running")
+        if run["state"] == "running":
+            logger.debug(f"recording suggestion run {run['name']} that is still running")
             self._num_running += 1
             return
 
-        objective = run.summary.get("carbs.objective", 0)
-        cost = run.summary.get("carbs.cost", 0)
+        objective = run["objective"]
+        cost = run["cost"]
+        is_failure = run["state"] == "failure"
 
-        if run.summary["carbs.state"] == "failure":
+        if is_failure:
             self._num_failures += 1
         else:
             self._num_observations += 1
 
-        logger.debug(
-            f"Observation {run.name} " +
-            f"{objective} / {cost} " +
-            f"failure: {run.summary['carbs.state'] == 'failure'} " +
-            json.dumps(suggestion, indent=2)
-        )
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                f"Observation {run['name']} " +
+                f"{objective} / {cost} " +
+                f"failure: {is_failure} " +
+                _jdumps(suggestion)
+            )
         self._observations.append({
             "suggestion": suggestion,
             "objective": objective,
             "cost": cost,
-            "is_failure": run.summary["carbs.state"] == "failure",
-            "run_id": run.id,
-            "run_name": run.name
+            "is_failure": is_failure,
+            "run_id": run["id"],
+            "run_name": run["name"]
         })
         self._carbs.observe(ObservationInParam(
             input=suggestion,
             output=objective,
             cost=cost,
-            is_failure=run.summary["carbs.state"] == "failure"
+            is_failure=is_failure
         ))
 
 
     def _suggestion_from_run(self, run):
-        suggestion = {
-            param.name: run.config.get(param.name, param.search_center)
-            for param in self._carbs.params
-        }
-        suggestion["suggestion_uuid"] = run.id
+        suggestion = dict(run["config"])
+        suggestion["suggestion_uuid"] = run["id"]
         return suggestion
 
     def _generate_carbs_suggestion(self):
@@ -237,27 +390,39 @@ class Pow2WandbCarbs(WandbCarbs):
             wandb_run: The Weights & Biases run object (optional).
         """
         self.pow2_params = pow2_params or set()
+        self._pow2_param_list = tuple(
+            param.name for param in carbs.params if param.name in self.pow2_params)
         super().__init__(carbs, wandb_run)
 
     def _transform_suggestion(self, suggestion):
-        for param in self._carbs.params:
-            if param.name in self.pow2_params:
-                suggestion[param.name] = 2 ** suggestion[param.name]
+        for name in self._pow2_param_list:
+            suggestion[name] = _pow2(suggestion[name])
         return suggestion
 
     def _suggestion_from_run(self, run):
         suggestion = super()._suggestion_from_run(run)
-        for param in self._carbs.params:
-            if param.name in self.pow2_params:
-                try:
-                    suggestion[param.name] = int(math.log2(suggestion[param.name]))
-                except ValueError as e:
-                    logger.warning(
-                        f"Failed to convert {run.name}:{param.name} to power of 2: {suggestion[param.name]}")
-                    raise e
+        for name in self._pow2_param_list:
+            try:
+                suggestion[name] = _log2(suggestion[name])
+            except ValueError as e:
+                logger.warning(
+                    f"Failed to convert {run['name']}:{name} to power of 2: {suggestion[name]}")
+                raise e
 
         return suggestion
 
+def _pow2(exponent):
+    # Shift for non-negative integer exponents, fall back to a float power otherwise
+    if exponent >= 0 and float(exponent).is_integer():
+        return 1 << int(exponent)
+    return 2 ** exponent
+
+def _log2(value):
+    # bit_length is exact for integers >= 1, fall back to log2 otherwise
+    if value >= 1 and float(value).is_integer():
+        return int(value).bit_length() - 1
+    return int(math.log2(value))
+
 def create_sweep(sweep_name: str, wandb_entity: str, wandb_project: str, carb_params: List[Param]):
     """
     Create a new wandb sweep based on CARBS parameters.
@@ -279,30 +444,32 @@ def create_sweep(sweep_name: str, wandb_entity: str, wandb_project: str, carb_pa
     return sweep_id
 
 def _wandb_sweep_cfg_from_carbs_params(name, carb_params: List[Param]):
-    wandb_sweep_cfg = {
+    return {
         "method": "bayes",
         "metric": {
             "goal": "maximize",
             "name": "carbs.objective",
         },
-        "parameters": {},
+        "parameters": {
+            param.name: {
+                "min": param.space.min,
+                "max": param.space.max,
+                "distribution": _wandb_distribution(param),
+            }
+            for param in carb_params
+        },
         "name": name,
     }
-    for param in carb_params:
-        wandb_sweep_cfg["parameters"][param.name] = {
-            "min": param.space.min,
-            "max": param.space.max,
-            "distribution": _wandb_distribution(param),
-        }
-    return wandb_sweep_cfg
+
+_DIST_MAP = {
+    LogSpace: "log_uniform_values",
+    LogitSpace: "uniform",
+}
 
 def _wandb_distribution(param: Param):
-    if isinstance(param.space, LogSpace):
-        return "log_uniform_values"
-    elif isinstance(param.space, LogitSpace):
-        return "uniform"
-    elif isinstance(param.space, LinearSpace):
-        if param.space.is_integer:
-            return "int_uniform"
-        else:
-            return "uniform"
+    for space_type in type(param.space).__mro__:
+        dist = _DIST_MAP.get(space_type)
+        if dist:
+            return dist
+    if isinstance(param.space, LinearSpace):
+        return "int_uniform" if param.space.is_integer else "uniform"